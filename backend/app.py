@@ -1,29 +1,60 @@
 import os
 import json
+import logging
+import time
+import asyncio
+import hashlib
+import hmac
+import base64
+import threading
 from datetime import datetime, timezone
-from flask import Flask, request, jsonify
-from flask_cors import CORS
+from quart import Quart, Response, g, request, jsonify
+from quart.json.provider import DefaultJSONProvider
+from quart_cors import cors
 from dotenv import load_dotenv
-from pymongo import MongoClient
-from pymongo.errors import ConnectionFailure, OperationFailure
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError, ConnectionFailure, DuplicateKeyError, OperationFailure
 from bson.objectid import ObjectId
-import requests
+import httpx
+import orjson
 import jwt
+from cachetools import TLRUCache, TTLCache
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential_jitter
+from aiolimiter import AsyncLimiter
+import redis.asyncio as redis
+from redis.exceptions import RedisError
 from clerk_backend_api import Clerk
-import uuid
+from cryptography.hazmat.primitives.serialization import load_pem_public_key
 
 # Load environment variables
 load_dotenv()
 
-app = Flask(__name__)
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"))
+logger = logging.getLogger(__name__)
+
+# orjson encodes datetimes natively. PyMongo returns naive UTC datetimes, so
+# they are emitted as ISO 8601 with a Z suffix.
+ORJSON_OPTIONS = orjson.OPT_NAIVE_UTC | orjson.OPT_UTC_Z
+
+# Route request.get_json() and jsonify through orjson instead of stdlib json
+class OrjsonProvider(DefaultJSONProvider):
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default, option=ORJSON_OPTIONS).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+app = Quart(__name__)
+app.json = OrjsonProvider(app)
 # Add CORS support - critical for frontend to backend communication
-CORS(app, origins=["http://localhost:5173"], supports_credentials=True)
+app = cors(app, allow_origin="http://localhost:5173", allow_credentials=True)
 
 # Clerk setup
 clerk_api_key = os.getenv("CLERK_API_KEY")
 clerk_jwt_key = os.getenv("JWKS_Public_Key")
-print(f"Clerk API Key exists: {bool(clerk_api_key)}")
-print(f"JWT Key exists: {bool(clerk_jwt_key)}")
+logger.info("Clerk API Key exists: %s", bool(clerk_api_key))
+logger.info("JWT Key exists: %s", bool(clerk_jwt_key))
 model_name = os.getenv("HUGGINGFACE_MODEL_REPO_ID", "deepseek/deepseek-v3-0324")
 api_key = os.getenv("HUGGINGFACE_API_KEY")
 hf_space_url = os.getenv("HF_SPACE_URL")
@@ -31,126 +62,388 @@ hf_space_url = os.getenv("HF_SPACE_URL")
 # Initialize Clerk client
 try:
     clerk_client = Clerk(clerk_api_key)
-    print("✅ Clerk client initialized successfully")
+    logger.info("✅ Clerk client initialized successfully")
 except Exception as e:
-    print(f"❌ Failed to initialize Clerk client: {str(e)}")
+    logger.error("❌ Failed to initialize Clerk client: %s", e)
     clerk_client = None
 
-# Custom function to verify JWT tokens
+# Parse the Clerk public key once instead of on every jwt.decode call
+try:
+    clerk_public_key = load_pem_public_key(clerk_jwt_key.encode()) if clerk_jwt_key else None
+except ValueError as e:
+    logger.error("❌ Failed to load JWT public key: %s", e)
+    clerk_public_key = None
+
+# Verified JWT claims, keyed by a digest of the raw token. Entries live for at
+# most 30s and never past the token's own expiry; failed tokens are not cached.
+JWT_CACHE_TTL = 30
+_jwt_cache = TLRUCache(
+    maxsize=10000,
+    ttu=lambda key, claims, now: min(now + JWT_CACHE_TTL, claims.get("exp", now + JWT_CACHE_TTL)),
+    timer=time.time
+)
+_jwt_cache_lock = threading.Lock()
+
+JWT_ALGORITHMS = ["RS256"]
+JWT_DECODE_OPTIONS = {"require": ["exp", "sub", "iat"], "verify_signature": True}
+JWT_LEEWAY = 30
+
+# Custom function to verify JWT tokens. jwt_key is the parsed public key object,
+# which PyJWT uses as-is instead of re-loading a PEM string on every call.
 def verify_token(token, jwt_key):
+    if jwt_key is None:
+        raise Exception("JWT public key is not configured")
+
+    key = hashlib.blake2b(token.encode(), digest_size=16).digest()
+    with _jwt_cache_lock:
+        cached = _jwt_cache.get(key)
+    if cached is not None and cached.get("exp", float("inf")) > time.time():
+        return cached
+
     try:
         decoded = jwt.decode(
             token,
             jwt_key,
-            algorithms=["HS256", "RS256"],
-            options={"verify_signature": True}
+            algorithms=JWT_ALGORITHMS,
+            options=JWT_DECODE_OPTIONS,
+            leeway=JWT_LEEWAY
         )
+        with _jwt_cache_lock:
+            _jwt_cache[key] = decoded
         return decoded
     except jwt.ExpiredSignatureError:
         raise Exception("Token has expired")
     except jwt.InvalidTokenError as e:
         raise Exception(f"Invalid token: {str(e)}")
 
-# MongoDB setup with error handling
-try:
-    mongo_uri = os.getenv("MONGODB_URI", "mongodb://localhost:27017/")
-    mongo_client = MongoClient(mongo_uri, serverSelectionTimeoutMS=5000)
-    mongo_client.admin.command('ping')
-    print("✅ Connected to MongoDB successfully")
-    
-    db = mongo_client.get_database("chat_app_db")
-    conversations_collection = db.conversations
-    users_collection = db.users
-    
-    # Create indexes
-    conversations_collection.create_index([("user_id", 1)])
-    conversations_collection.create_index([("conversation_id", 1)], unique=True)
-    users_collection.create_index([("user_id", 1)], unique=True)
-except ConnectionFailure:
-    print("❌ Failed to connect to MongoDB. Please check if MongoDB is running.")
-except Exception as e:
-    print(f"❌ MongoDB setup error: {str(e)}")
+# MongoDB setup - the Motor client connects lazily, so the connectivity check
+# and index creation run once the event loop is up
+mongo_uri = os.getenv("MONGODB_URI", "mongodb://localhost:27017/")
+mongo_client = AsyncIOMotorClient(
+    mongo_uri,
+    serverSelectionTimeoutMS=5000,
+    maxPoolSize=200,
+    minPoolSize=10,
+    maxConnecting=8,
+    maxIdleTimeMS=60000,
+    socketTimeoutMS=10000,
+    retryWrites=True,
+    compressors="zstd,snappy,zlib"
+)
+db = mongo_client.get_database("chat_app_db")
+conversations_collection = db.conversations
+# Append-only log of every chat turn; the hot conversation documents only keep
+# the most recent MAX_CONVERSATION_MESSAGES messages
+conversations_archive_collection = db.conversations_archive
+users_collection = db.users
 
-# Hugging Face configs
-model_name = os.getenv("HUGGINGFACE_MODEL_REPO_ID", "google/flan-t5-small")
-hf_api_key = os.getenv("HUGGINGFACE_API_KEY")
-hf_space_url = os.getenv("HF_SPACE_URL")
+# Shared HTTP/2 client so HuggingFace calls reuse connections and never block the loop
+hf_client = httpx.AsyncClient(
+    http2=True,
+    headers={"Authorization": f"Bearer {api_key}"} if api_key else None,
+    limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+    timeout=httpx.Timeout(120.0, connect=5.0)
+)
 
-# Middleware to verify Clerk JWT and check user in DB
-def require_auth(f):
-    def decorated(*args, **kwargs):
-        auth_header = request.headers.get("Authorization")
-        if not auth_header or not auth_header.startswith("Bearer "):
-            return jsonify({"error": "Missing or invalid Authorization header"}), 401
+# Optional Redis look-aside cache for model replies to identical prompts
+redis_url = os.getenv("REDIS_URL")
+redis_client = redis.from_url(redis_url, decode_responses=True) if redis_url else None
+HF_RESPONSE_CACHE_TTL = int(os.getenv("HF_RESPONSE_CACHE_TTL", "86400"))
+
+# Users recently upserted by authenticate_request. While a user is in here, their
+# last_active bumps are collected in memory and written in one bulk_write.
+USER_SEEN_TTL = 60
+LAST_ACTIVE_FLUSH_INTERVAL = 30
+_user_seen = TTLCache(maxsize=50000, ttl=USER_SEEN_TTL)
+_pending_last_active = {}
+_user_seen_lock = threading.Lock()
+_last_active_flusher = None
+
+async def flush_last_active():
+    with _user_seen_lock:
+        pending = dict(_pending_last_active)
+        _pending_last_active.clear()
+    if not pending:
+        return
+
+    try:
+        await users_collection.bulk_write(
+            [UpdateOne({"user_id": user_id}, {"$max": {"last_active": seen_at}})
+             for user_id, seen_at in pending.items()],
+            ordered=False
+        )
+    except Exception as e:
+        logger.error("❌ Failed to flush last_active updates: %s", e)
+
+async def flush_last_active_periodically():
+    while True:
+        await asyncio.sleep(LAST_ACTIVE_FLUSH_INTERVAL)
+        await flush_last_active()
 
-        token = auth_header.split(" ")[1]
+@app.before_serving
+async def start_last_active_flusher():
+    global _last_active_flusher
+    _last_active_flusher = asyncio.create_task(flush_last_active_periodically())
+
+@app.after_serving
+async def stop_last_active_flusher():
+    if _last_active_flusher:
+        _last_active_flusher.cancel()
+    await flush_last_active()
+
+# Chat turns are persisted off the request path: handlers enqueue a conversation
+# UpdateOne plus an archive InsertOne, and a single writer task sends them in
+# bulk_write batches of up to 50 turns, or whatever arrived within 100ms. One
+# writer keeps turns of a conversation in order.
+CHAT_WRITE_BATCH_SIZE = 50
+CHAT_WRITE_FLUSH_INTERVAL = 0.1
+_chat_write_queue = asyncio.Queue(maxsize=10000)
+_chat_writer = None
+
+# Ordered bulk_write stops at the first failing op. Log the conversation that
+# failed and retry the ops after it, so one bad op doesn't drop unrelated turns.
+# Returns the turns that were saved, so only those get archived.
+async def write_conversation_turns(turns):
+    saved = []
+    while turns:
         try:
-            claims = verify_token(token, clerk_jwt_key)
-            user_id = claims["sub"]
-            request.user_id = user_id
-            
-            # Check if user exists in DB, if not create one
+            await conversations_collection.bulk_write([conversation_op for _, conversation_op, _ in turns])
+            return saved + turns
+        except BulkWriteError as e:
+            write_errors = e.details.get("writeErrors", [])
+            if not write_errors:
+                # Only a write concern error; every op was applied
+                logger.error("❌ Chat turns saved with a write concern error: %s", e.details)
+                return saved + turns
+            failed_index = write_errors[0]["index"]
+            logger.error(
+                "❌ Lost chat turn for conversation %s: %s",
+                turns[failed_index][0], write_errors[0].get("errmsg")
+            )
+            saved.extend(turns[:failed_index])
+            turns = turns[failed_index + 1:]
+        except Exception as e:
+            logger.error(
+                "❌ Lost chat turns for conversations %s: %s",
+                ", ".join(conversation_id for conversation_id, _, _ in turns), e
+            )
+            return saved
+    return saved
+
+async def write_chat_turns():
+    loop = asyncio.get_running_loop()
+    while True:
+        turn = await _chat_write_queue.get()
+        if turn is None:
+            return
+
+        turns = [turn]
+        deadline = loop.time() + CHAT_WRITE_FLUSH_INTERVAL
+        stopping = False
+        while len(turns) < CHAT_WRITE_BATCH_SIZE:
             try:
-                existing_user = users_collection.find_one({"user_id": user_id})
-                if not existing_user:
-                    if not clerk_client:
-                        raise Exception("Clerk client not initialized")
-                    
-                    # Fetch user details from Clerk
-                    try:
-                        clerk_user = clerk_client.users.get(user_id)
-                        users_collection.insert_one({
-                            "user_id": user_id,
-                            "email": clerk_user.email_addresses[0].email_address if clerk_user.email_addresses else None,
-                            "first_name": clerk_user.first_name,
-                            "last_name": clerk_user.last_name,
-                            "created_at": datetime.now(timezone.utc),
-                            "last_active": datetime.now(timezone.utc)
-                        })
-                        print(f"✅ Created user {user_id} in database")
-                    except Exception as e:
-                        print(f"❌ Failed to fetch user from Clerk: {str(e)}")
-                        raise Exception(f"Clerk API error: {str(e)}")
-                else:
-                    # Update last active timestamp
-                    users_collection.update_one(
-                        {"user_id": user_id},
-                        {"$set": {"last_active": datetime.now(timezone.utc)}}
-                    )
+                turn = await asyncio.wait_for(_chat_write_queue.get(), deadline - loop.time())
+            except asyncio.TimeoutError:
+                break
+            if turn is None:
+                stopping = True
+                break
+            turns.append(turn)
+
+        saved = await write_conversation_turns(turns)
+        if saved:
+            try:
+                await conversations_archive_collection.bulk_write(
+                    [archive_op for _, _, archive_op in saved], ordered=False
+                )
             except Exception as e:
-                print(f"❌ User database operation failed: {str(e)}")
-                return jsonify({"error": "Failed to process user data", "details": str(e)}), 500
-                
+                logger.error("❌ Failed to archive %d chat turns: %s", len(saved), e)
+        if stopping:
+            return
+
+@app.before_serving
+async def start_chat_writer():
+    global _chat_writer
+    _chat_writer = asyncio.create_task(write_chat_turns())
+
+@app.after_serving
+async def stop_chat_writer():
+    # Let the writer drain whatever is still queued before Mongo is closed
+    if _chat_writer:
+        await _chat_write_queue.put(None)
+        await _chat_writer
+
+@app.before_serving
+async def setup_database():
+    try:
+        await mongo_client.admin.command('ping')
+        logger.info("✅ Connected to MongoDB successfully")
+
+        # Create indexes. conversation_id stays globally unique so a conversation
+        # id can only ever name one document, whichever endpoint created it.
+        await conversations_collection.create_index([("conversation_id", 1)], unique=True)
+        # Serves listing a user's conversations newest first without an in-memory sort
+        await conversations_collection.create_index([("user_id", 1), ("updated_at", -1)])
+        # user_id_1 is covered by the prefix of (user_id, updated_at), and
+        # (user_id, conversation_id) adds nothing over the unique conversation_id index
+        for index_name in ("user_id_1", "user_id_1_conversation_id_1"):
+            try:
+                await conversations_collection.drop_index(index_name)
+            except OperationFailure:
+                pass  # Already dropped
+        await conversations_archive_collection.create_index(
+            [("conversation_id", 1), ("created_at", 1)]
+        )
+        await users_collection.create_index([("user_id", 1)], unique=True)
+        # save_user looks users up by email; users without one are left out
+        await users_collection.create_index(
+            [("email", 1)],
+            unique=True,
+            partialFilterExpression={"email": {"$type": "string"}}
+        )
+    except ConnectionFailure:
+        logger.error("❌ Failed to connect to MongoDB. Please check if MongoDB is running.")
+    except Exception as e:
+        logger.error("❌ MongoDB setup error: %s", e)
+
+@app.after_serving
+async def close_clients():
+    await hf_client.aclose()
+    mongo_client.close()
+    if redis_client:
+        await redis_client.aclose()
+
+# Fill in profile fields for a user first seen through authenticate_request
+async def enrich_user_from_clerk(user_id):
+    if not clerk_client:
+        logger.error("❌ Clerk client not initialized")
+        return
+
+    try:
+        clerk_user = await clerk_client.users.get_async(user_id=user_id)
+        profile = {
+            "email": clerk_user.email_addresses[0].email_address if clerk_user.email_addresses else None,
+            "first_name": clerk_user.first_name,
+            "last_name": clerk_user.last_name
+        }
+        await users_collection.update_one(
+            {"user_id": user_id},
+            {"$set": profile}
+        )
+        logger.info("✅ Enriched user %s with Clerk profile", user_id)
+    except Exception as e:
+        logger.error("❌ Failed to fetch user from Clerk: %s", e)
+
+# Endpoints that need a verified Clerk user; checked once per request by
+# authenticate_request instead of wrapping each view
+PROTECTED_ENDPOINTS = {"chat", "get_conversations"}
+
+# Middleware to verify Clerk JWT and check user in DB
+@app.before_request
+async def authenticate_request():
+    # CORS preflights carry no credentials
+    if request.endpoint not in PROTECTED_ENDPOINTS or request.method == "OPTIONS":
+        return None
+
+    auth_header = request.headers.get("Authorization")
+    if not auth_header or not auth_header.startswith("Bearer "):
+        return jsonify({"error": "Missing or invalid Authorization header"}), 401
+
+    token = auth_header[len("Bearer "):]
+    try:
+        claims = verify_token(token, clerk_public_key)
+        user_id = claims["sub"]
+        g.user_id = user_id
+        
+        # Create the user if missing and bump last_active in a single round-trip,
+        # unless they were seen recently and the bump can be batched
+        try:
+            now = datetime.now(timezone.utc)
+            with _user_seen_lock:
+                recently_seen = user_id in _user_seen
+                if recently_seen:
+                    _pending_last_active[user_id] = now
+
+            if not recently_seen:
+                result = await users_collection.update_one(
+                    {"user_id": user_id},
+                    {
+                        "$set": {"last_active": now},
+                        "$setOnInsert": {"created_at": now}
+                    },
+                    upsert=True
+                )
+                if result.upserted_id is not None:
+                    # Profile details come from Clerk off the request path
+                    app.add_background_task(enrich_user_from_clerk, user_id)
+                with _user_seen_lock:
+                    _user_seen[user_id] = now
         except Exception as e:
-            print(f"❌ Token verification failed: {str(e)}")
-            return jsonify({"error": "Invalid or expired token", "details": str(e)}), 401
+            logger.error("❌ User database operation failed: %s", e)
+            return jsonify({"error": "Failed to process user data", "details": str(e)}), 500
+            
+    except Exception as e:
+        logger.warning("❌ Token verification failed: %s", e)
+        return jsonify({"error": "Invalid or expired token", "details": str(e)}), 401
 
-        return f(*args, **kwargs)
-    decorated.__name__ = f.__name__
-    return decorated
+# Clerk signs webhooks through Svix with a "whsec_"-prefixed base64 secret
+webhook_secret = os.getenv("CLERK_WEBHOOK_SECRET")
+try:
+    webhook_signing_key = base64.b64decode(webhook_secret.removeprefix("whsec_")) if webhook_secret else None
+except ValueError as e:
+    logger.error("❌ Failed to load webhook signing secret: %s", e)
+    webhook_signing_key = None
+WEBHOOK_TOLERANCE_SECONDS = 300
+
+def verify_webhook_signature(headers, body):
+    svix_id = headers.get("svix-id")
+    svix_timestamp = headers.get("svix-timestamp")
+    svix_signature = headers.get("svix-signature")
+    if not svix_id or not svix_timestamp or not svix_signature:
+        return False
+
+    # Reject stale or future-dated deliveries to limit replays
+    try:
+        if abs(time.time() - int(svix_timestamp)) > WEBHOOK_TOLERANCE_SECONDS:
+            return False
+    except ValueError:
+        return False
+
+    signed_content = f"{svix_id}.{svix_timestamp}.".encode() + body
+    expected = base64.b64encode(hmac.new(webhook_signing_key, signed_content, hashlib.sha256).digest())
+
+    # The header holds space-separated "v1,<signature>" entries, one per active secret
+    for versioned_signature in svix_signature.split():
+        version, _, signature = versioned_signature.partition(",")
+        if version == "v1" and hmac.compare_digest(signature.encode(), expected):
+            return True
+    return False
 
 # Clerk webhook endpoint for user creation
 @app.route("/webhook/user", methods=["POST"])
-def handle_clerk_webhook():
-    print("📩 Received Clerk webhook event")
+async def handle_clerk_webhook():
+    logger.debug("📩 Received Clerk webhook event")
     
+    body = await request.get_data()
+
+    # Verify the webhook signature before touching the payload. A configured
+    # secret that failed to load rejects everything rather than nothing.
+    if webhook_secret and (not webhook_signing_key or not verify_webhook_signature(request.headers, body)):
+        logger.warning("❌ Rejected webhook with an invalid signature")
+        return jsonify({"error": "Invalid webhook signature"}), 401
+
     # Log raw webhook data for debugging
     try:
-        data = request.get_json()
-        print(f"📨 Webhook data: {json.dumps(data, indent=2)}")
+        data = orjson.loads(body)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("📨 Webhook data: %s", json.dumps(data, indent=2))
     except Exception as e:
-        print(f"❌ Failed to parse webhook JSON: {str(e)}")
+        logger.warning("❌ Failed to parse webhook JSON: %s", e)
         return jsonify({"error": "Invalid JSON"}), 400
     
-    # Verify webhook signature (recommended for production)
-    webhook_secret = os.getenv("CLERK_WEBHOOK_SECRET")
-    if webhook_secret:
-        # You would implement signature verification here
-        pass
-    
     # Handle various event types
     event_type = data.get("type") if data else None
-    print(f"📣 Event type: {event_type}")
+    logger.debug("📣 Event type: %s", event_type)
     
     if not event_type:
         return jsonify({"error": "Missing event type"}), 400
@@ -161,7 +454,7 @@ def handle_clerk_webhook():
     if not user_id:
         return jsonify({"error": "Missing user ID in webhook data"}), 400
         
-    print(f"👤 Processing user: {user_id}")
+    logger.debug("👤 Processing user: %s", user_id)
     
     # Handle different event types
     if event_type == "user.created" or event_type == "user.updated":
@@ -174,46 +467,35 @@ def handle_clerk_webhook():
             first_name = user_data.get("first_name", "")
             last_name = user_data.get("last_name", "")
             
-            print(f"📧 Email: {email}, Name: {first_name} {last_name}")
+            logger.debug("📧 Email: %s, Name: %s %s", email, first_name, last_name)
             
-            # Check if user exists
-            existing_user = users_collection.find_one({"user_id": user_id})
             now = datetime.now(timezone.utc)
+            update_data = {
+                "last_active": now,
+                "last_updated": now
+            }
             
-            if existing_user and event_type == "user.updated":
-                # Update existing user
-                update_data = {
-                    "last_active": now,
-                    "last_updated": now
-                }
-                
-                # Only update fields if they exist in the webhook data
-                if email:
-                    update_data["email"] = email
-                if first_name:
-                    update_data["first_name"] = first_name
-                if last_name:
-                    update_data["last_name"] = last_name
-                
-                users_collection.update_one(
-                    {"user_id": user_id},
-                    {"$set": update_data}
-                )
-                print(f"✅ Updated user {user_id} in database")
-                
-            elif not existing_user:
-                # Create new user
-                users_collection.insert_one({
-                    "user_id": user_id,
-                    "email": email,
-                    "first_name": first_name,
-                    "last_name": last_name,
-                    "created_at": now,
-                    "last_active": now
-                })
-                print(f"✅ Created user {user_id} in database via webhook")
+            # Only update fields if they exist in the webhook data
+            if email:
+                update_data["email"] = email
+            if first_name:
+                update_data["first_name"] = first_name
+            if last_name:
+                update_data["last_name"] = last_name
+            
+            # Create or update the user in a single round-trip
+            result = await users_collection.update_one(
+                {"user_id": user_id},
+                {
+                    "$set": update_data,
+                    "$setOnInsert": {"created_at": now}
+                },
+                upsert=True
+            )
+            if result.upserted_id is not None:
+                logger.info("✅ Created user %s in database via webhook", user_id)
             else:
-                print(f"ℹ️ User {user_id} already exists in database")
+                logger.info("✅ Updated user %s in database", user_id)
             
             return jsonify({
                 "success": True, 
@@ -222,21 +504,21 @@ def handle_clerk_webhook():
             })
             
         except Exception as e:
-            error_msg = f"❌ Webhook user processing failed: {str(e)}"
-            print(error_msg)
-            return jsonify({"error": error_msg}), 500
+            logger.error("❌ Webhook user processing failed: %s", e)
+            return jsonify({"error": f"❌ Webhook user processing failed: {e}"}), 500
     
     # Return for other event types
     return jsonify({"success": True, "message": "Event acknowledged", "event": event_type})
 
 # Add this checking endpoint to debug Clerk webhook format
 @app.route("/dev/webhook-test", methods=["POST"])
-def dev_webhook_test():
+async def dev_webhook_test():
     if not os.getenv("FLASK_ENV") == "development" and not os.getenv("DEBUG") == "1":
         return jsonify({"error": "This endpoint is only available in development mode"}), 403
         
-    data = request.get_json()
-    print("Received webhook test data:", json.dumps(data, indent=2))
+    data = await request.get_json()
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Received webhook test data: %s", json.dumps(data, indent=2))
     
     return jsonify({
         "received": True,
@@ -246,7 +528,7 @@ def dev_webhook_test():
 
 # Add an endpoint to check webhook operation
 @app.route("/dev/check-webhook", methods=["GET"])
-def check_webhook_status():
+async def check_webhook_status():
     if not os.getenv("FLASK_ENV") == "development" and not os.getenv("DEBUG") == "1":
         return jsonify({"error": "This endpoint is only available in development mode"}), 403
     
@@ -265,11 +547,11 @@ def check_webhook_status():
 
 # Test endpoint to manually trigger user creation (for debugging)
 @app.route("/dev/users/create", methods=["POST"])
-def dev_create_user():
+async def dev_create_user():
     if not os.getenv("FLASK_ENV") == "development" and not os.getenv("DEBUG") == "1":
         return jsonify({"error": "This endpoint is only available in development mode"}), 403
     
-    data = request.get_json()
+    data = await request.get_json()
     user_id = data.get("user_id")
     email = data.get("email")
     first_name = data.get("first_name")
@@ -279,30 +561,30 @@ def dev_create_user():
         return jsonify({"error": "user_id and email are required"}), 400
     
     try:
-        existing_user = users_collection.find_one({"user_id": user_id})
-        if existing_user:
-            return jsonify({"error": "User already exists"}), 409
-        
-        users_collection.insert_one({
+        # The unique user_id index rejects existing users, no lookup needed
+        now = datetime.now(timezone.utc)
+        await users_collection.insert_one({
             "user_id": user_id,
             "email": email,
             "first_name": first_name,
             "last_name": last_name,
-            "created_at": datetime.now(timezone.utc),
-            "last_active": datetime.now(timezone.utc)
+            "created_at": now,
+            "last_active": now
         })
         return jsonify({"success": True, "message": f"User {user_id} created"})
+    except DuplicateKeyError:
+        return jsonify({"error": "User already exists"}), 409
     except Exception as e:
-        print(f"❌ Dev user creation failed: {str(e)}")
+        logger.error("❌ Dev user creation failed: %s", e)
         return jsonify({"error": "Failed to create user", "details": str(e)}), 500
     
     
 
 
 @app.route('/api/save-user', methods=["POST"])
-def save_user():
+async def save_user():
     try:
-        user_data = request.get_json()
+        user_data = await request.get_json()
         if not user_data:
             return jsonify({"error": "Missing user data"}), 400
         
@@ -312,68 +594,289 @@ def save_user():
 
         if not email:
             return jsonify({"error": "Email is required"}), 400
+        # Without a Clerk id the upsert would insert a user with no user_id,
+        # which the unique user_id index allows only once
+        if not clerk_id:
+            return jsonify({"error": "clerkid is required"}), 400
 
-        existing_user = users_collection.find_one({"email": email})
-
+        # Create or update the user in a single round-trip. Key on the Clerk id:
+        # authenticate_request may already have created the user without an
+        # email, so an email filter would miss that document.
         now = datetime.now(timezone.utc)
-        if existing_user:
-            users_collection.update_one(
-                {"user_id": clerk_id},
-                {
-                    "$set": {
-                        "email": email,
-                        "name": first_name,
-                        "last_active": now,
-                        "last_updated": now
-                    }
-                }
-            )
-            return jsonify({"message": "User updated successfully", "user_id": clerk_id}), 200
-        else:
-            users_collection.insert_one({
-                "clerk_id" : clerk_id,
-                "email": email,
-                "name": first_name,
-                "created_at": now,
-                "last_active": now
-            })
+        result = await users_collection.update_one(
+            {"user_id": clerk_id},
+            {
+                "$set": {
+                    "email": email,
+                    "name": first_name,
+                    "last_active": now,
+                    "last_updated": now
+                },
+                "$setOnInsert": {"created_at": now}
+            },
+            upsert=True
+        )
+        if result.upserted_id is not None:
             return jsonify({"message": "User created successfully", "user_id": clerk_id}), 201
+        return jsonify({"message": "User updated successfully", "user_id": clerk_id}), 200
 
     except Exception as e:
-        print(f"Error in save_user: {str(e)}")
+        logger.error("Error in save_user: %s", e)
         return jsonify({"error": "Failed to save user", "details": str(e)}), 500
 
-def call_huggingface_chat_model(message):
+HF_CHAT_COMPLETIONS_URL = "https://router.huggingface.co/novita/v3/openai/chat/completions"
+
+# Cache keys hash "<model>|<prompt>"; the model prefix is hashed once up front
+_hf_cache_key_hasher = hashlib.blake2b(f"{model_name}|".encode(), digest_size=16)
+
+def hf_cache_key(message):
+    hasher = _hf_cache_key_hasher.copy()
+    hasher.update(message.encode())
+    return "hf:" + hasher.hexdigest()
+
+def chat_payload(message, stream=False):
+    payload = {
+        "messages": [{"role": "user", "content": message}],
+        "model": model_name
+    }
+    if stream:
+        payload["stream"] = True
+    return payload
+
+# Cache failures are logged and treated as misses so chat keeps working without Redis
+async def get_cached_hf_response(message):
+    if not redis_client:
+        return None
+    try:
+        return await redis_client.get(hf_cache_key(message))
+    except RedisError as e:
+        logger.warning("❌ Redis cache lookup failed: %s", e)
+        return None
+
+async def cache_hf_response(message, response_text):
+    if not redis_client:
+        return
+    try:
+        await redis_client.set(hf_cache_key(message), response_text, ex=HF_RESPONSE_CACHE_TTL)
+    except RedisError as e:
+        logger.warning("❌ Redis cache write failed: %s", e)
+
+# Caps in-flight HuggingFace requests per worker; excess calls wait their turn
+HF_CONCURRENCY_LIMIT = int(os.getenv("HF_CONCURRENCY_LIMIT", "8"))
+_hf_semaphore = asyncio.Semaphore(HF_CONCURRENCY_LIMIT)
+
+# Optional client-side rate limit to stay under the HF router's per-minute quota
+hf_requests_per_minute = os.getenv("HF_REQUESTS_PER_MINUTE")
+_hf_limiter = AsyncLimiter(int(hf_requests_per_minute), 60) if hf_requests_per_minute else None
+
+HF_MAX_ATTEMPTS = 3
+HF_RETRY_MAX_WAIT = 8
+_hf_backoff = wait_exponential_jitter(initial=0.5, max=HF_RETRY_MAX_WAIT)
+
+# Only failures before the request reached HF are safe to resend; a read or
+# write timeout may already have been billed for a full generation
+def is_retryable_hf_error(exc):
+    if isinstance(exc, httpx.HTTPStatusError):
+        return exc.response.status_code == 429 or exc.response.status_code >= 500
+    return isinstance(exc, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout))
+
+HF_MODEL_LOADING_MAX_WAIT = 5
+
+# Honor Retry-After on rate-limited responses and the estimated_time HF sends
+# with a 503 while the model is loading, otherwise back off with jitter
+def wait_for_hf_retry(retry_state):
+    exc = retry_state.outcome.exception()
+    if isinstance(exc, httpx.HTTPStatusError) and exc.response.status_code == 429:
+        retry_after = exc.response.headers.get("Retry-After", "")
+        if retry_after.isdigit():
+            return min(float(retry_after), HF_RETRY_MAX_WAIT)
+    if isinstance(exc, httpx.HTTPStatusError) and exc.response.status_code == 503:
+        try:
+            estimated_time = float(orjson.loads(exc.response.content)["estimated_time"])
+        except (orjson.JSONDecodeError, KeyError, TypeError, ValueError):
+            estimated_time = None
+        if estimated_time is not None:
+            return min(max(estimated_time, 0), HF_MODEL_LOADING_MAX_WAIT)
+    return _hf_backoff(retry_state)
+
+@retry(
+    retry=retry_if_exception(is_retryable_hf_error),
+    wait=wait_for_hf_retry,
+    stop=stop_after_attempt(HF_MAX_ATTEMPTS),
+    reraise=True
+)
+# Each attempt takes its own _hf_semaphore slot, so backoff sleeps between
+# retries don't hold one. A streamed response keeps its slot until the caller
+# closes it with release_chat_completion.
+async def send_chat_completion(payload, stream=False):
+    if _hf_limiter:
+        await _hf_limiter.acquire()
+
+    await _hf_semaphore.acquire()
+    try:
+        response = await hf_client.send(
+            hf_client.build_request("POST", HF_CHAT_COMPLETIONS_URL, json=payload),
+            stream=stream
+        )
+        if response.is_error:
+            # Read the body so the error details survive the closed stream
+            await response.aread()
+            response.raise_for_status()
+    except BaseException:
+        _hf_semaphore.release()
+        raise
+    if not stream:
+        _hf_semaphore.release()
+    return response
+
+async def release_chat_completion(response):
+    try:
+        await response.aclose()
+    finally:
+        _hf_semaphore.release()
+
+# Cold paths for bodies that don't match the OpenAI chat-completion shape
+def parse_unexpected_completion(completion):
+    if isinstance(completion, dict) and "error" in completion:
+        error = completion["error"]
+        if isinstance(error, dict):
+            error = error.get("message", error)
+        raise ValueError(f"HuggingFace error: {error}")
+    # Text-generation style reply: [{"generated_text": ...}]
+    if isinstance(completion, list) and completion and isinstance(completion[0], dict) and "generated_text" in completion[0]:
+        return completion[0]["generated_text"]
+    raise ValueError("Unexpected HuggingFace response format")
+
+def parse_unexpected_stream_event(event):
+    if isinstance(event, dict) and "error" in event:
+        parse_unexpected_completion(event)
+    # Chunks without choices (e.g. a trailing usage report) carry no text
+    return None
+
+async def call_huggingface_chat_model(message):
     if not api_key:
         raise ValueError("HuggingFace API key is not configured")
+
+    cached = await get_cached_hf_response(message)
+    if cached is not None:
+        return cached
     
     try:
-        API_URL = "https://router.huggingface.co/novita/v3/openai/chat/completions"
-        headers = {"Authorization": f"Bearer {api_key}"}
-        payload = {
-            "messages": [
-                {
-                    "role": "user",
-                    "content": message
-                }
-            ],
-            "model": f"{model_name}"
-        }
-        
-        response = requests.post(API_URL, headers=headers, json=payload)
-        return response.json()["choices"][0]["message"]["content"]
+        response = await send_chat_completion(chat_payload(message))
+        completion = orjson.loads(response.content)
+        try:
+            response_text = completion["choices"][0]["message"]["content"]
+        except (KeyError, IndexError, TypeError):
+            response_text = parse_unexpected_completion(completion)
+        # Never cache an empty reply; it would be served for every repeat of the prompt
+        if response_text:
+            await cache_hf_response(message, response_text)
+        return response_text
         
-    except requests.exceptions.RequestException as e:
-        print(f"Request failed: {str(e)}")
-        if hasattr(e, 'response') and e.response:
-            print(f"Response content: {e.response.text}")
+    except httpx.HTTPError as e:
+        logger.error("Request failed: %s", e)
+        if getattr(e, 'response', None) is not None:
+            logger.error("Response content: %s", e.response.text)
+        raise
+
+# Same request as call_huggingface_chat_model, but yields content deltas from
+# the OpenAI-style SSE stream as the model produces them
+async def stream_huggingface_chat_model(message):
+    if not api_key:
+        raise ValueError("HuggingFace API key is not configured")
+
+    cached = await get_cached_hf_response(message)
+    if cached is not None:
+        yield cached
+        return
+
+    chunks = []
+    try:
+        response = await send_chat_completion(chat_payload(message, stream=True), stream=True)
+        try:
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                chunk = line[len("data:"):].strip()
+                if chunk == "[DONE]":
+                    break
+                event = orjson.loads(chunk)
+                try:
+                    # Some providers send "delta": null on role-only or final chunks
+                    delta = (event["choices"][0].get("delta") or {}).get("content")
+                except (KeyError, IndexError, TypeError):
+                    delta = parse_unexpected_stream_event(event)
+                if delta:
+                    chunks.append(delta)
+                    yield delta
+        finally:
+            await release_chat_completion(response)
+        if chunks:
+            await cache_hf_response(message, "".join(chunks))
+    except httpx.HTTPError as e:
+        logger.error("Streaming request failed: %s", e)
+        if getattr(e, 'response', None) is not None:
+            logger.error("Response content: %s", e.response.text)
         raise
     
-    
+
+# Serialize straight to bytes, skipping jsonify's provider lookup and the
+# provider's str round-trip; used on the hot /chat and /conversations paths
+def ojsonify(payload, status=200):
+    return Response(
+        orjson.dumps(payload, default=str, option=ORJSON_OPTIONS),
+        status=status,
+        mimetype="application/json"
+    )
+
+CONVERSATION_PAGE_SIZE = 50
+MAX_CONVERSATION_PAGE_SIZE = 100
+
+@app.route("/conversations", methods=["GET"])
+async def get_conversations():
+    """List the caller's conversations for the sidebar, newest first.
+
+    Only metadata and the last message are returned. Pass ?limit=N (max 100)
+    and ?before=<updated_at of the last item> to page through older ones.
+    """
+    try:
+        limit = int(request.args.get("limit", CONVERSATION_PAGE_SIZE))
+    except ValueError:
+        return jsonify({"error": "limit must be an integer"}), 400
+    if limit < 1:
+        return jsonify({"error": "limit must be positive"}), 400
+    limit = min(limit, MAX_CONVERSATION_PAGE_SIZE)
+
+    query = {"user_id": g.user_id}
+    before = request.args.get("before")
+    if before:
+        try:
+            query["updated_at"] = {"$lt": datetime.fromisoformat(before)}
+        except ValueError:
+            return jsonify({"error": "before must be an ISO 8601 timestamp"}), 400
+
+    cursor = conversations_collection.find(
+        query,
+        {
+            "_id": 0,
+            "conversation_id": 1,
+            "title": 1,
+            "created_at": 1,
+            "updated_at": 1,
+            "messages": {"$slice": -1}
+        }
+    ).sort("updated_at", -1).limit(limit)
+    conversations = await cursor.to_list(length=limit)
+
+    for conv in conversations:
+        last_messages = conv.pop("messages", [])
+        conv["last_message"] = last_messages[0] if last_messages else None
+
+    return ojsonify(conversations)
 
 @app.route('/save-convo', methods=['POST'])
-def save_convo():
-    data = request.json
+async def save_convo():
+    data = await request.get_json()
 
     conversation_id = data.get('conversationId')
     user_id = data.get('userId')
@@ -383,84 +886,141 @@ def save_convo():
     if not all([conversation_id, user_id, title, messages]):
         return jsonify({"error": "Missing fields"}), 400
 
-    existing_convo = conversations_collection.find_one({"conversation_id": conversation_id})
+    # Create or replace the conversation in a single round-trip
+    now = datetime.now(timezone.utc)
+    try:
+        result = await conversations_collection.update_one(
+            {"conversation_id": conversation_id, "user_id": user_id},
+            {
+                "$set": {"title": title, "messages": messages, "updated_at": now},
+                "$setOnInsert": {"created_at": now}
+            },
+            upsert=True
+        )
+    except DuplicateKeyError:
+        # The conversation id already belongs to a different owner
+        return jsonify({"error": "Conversation already exists"}), 409
+
+    status = 201 if result.upserted_id is not None else 200
+    return jsonify({"success": True, "conversationId": conversation_id}), status
 
-    convo_data = {
-        "conversation_id": conversation_id,
-        "user_id": user_id,
-        "title": title,
-        "messages": messages,
-        "updated_at": datetime.utcnow()
-    }
+MAX_CONVERSATION_MESSAGES = 200
 
-    if existing_convo:
-        # Update existing conversation
-        conversations_collection.update_one(
-            {"conversation_id": conversation_id},
-            {"$set": convo_data}
-        )
-        return jsonify({"success": True, "conversationId": conversation_id}), 200
-    else:
-        # Create new conversation
-        convo_data["created_at"] = datetime.utcnow()
-        conversations_collection.insert_one(convo_data)
-        return jsonify({"success": True, "conversationId": conversation_id}), 201
+# Queue a user/bot exchange to be appended to a conversation, creating it on
+# the first message. Older messages fall off the capped array but stay in the archive.
+async def save_chat_turn(conversation_id, user_id, inputs, response_text):
+    now = datetime.now(timezone.utc)
+    messages = [
+        {"sender": "user", "text": inputs},
+        {"sender": "bot", "text": response_text}
+    ]
+    await _chat_write_queue.put((
+        conversation_id,
+        UpdateOne(
+            # Conversations saved before /chat was authenticated have no
+            # user_id; the first signed-in user to continue one takes it over
+            {
+                "conversation_id": conversation_id,
+                "$or": [{"user_id": user_id}, {"user_id": {"$exists": False}}]
+            },
+            {
+                "$push": {
+                    "messages": {
+                        "$each": messages,
+                        "$slice": -MAX_CONVERSATION_MESSAGES
+                    }
+                },
+                "$set": {"user_id": user_id, "updated_at": now},
+                "$setOnInsert": {
+                    "title": inputs[:50],  # Truncate for title
+                    "created_at": now
+                }
+            },
+            upsert=True
+        ),
+        InsertOne({
+            "conversation_id": conversation_id,
+            "user_id": user_id,
+            "messages": messages,
+            "created_at": now
+        })
+    ))
+
+def sse_event(payload):
+    return b"data: " + orjson.dumps(payload) + b"\n\n"
+
+MAX_INPUT_CHARS = int(os.getenv("MAX_INPUT_CHARS", "8000"))
 
 #calling model from huggingface
 @app.route("/chat", methods=["POST"])
-def chat():
-    """Handle user messages and return model responses."""
-    data = request.get_json()
+async def chat():
+    """Handle user messages and return model responses.
+
+    With "stream": true in the body, the reply is sent as server-sent events:
+    {"delta": ...} chunks followed by a final {"done": true} event.
+    """
+    data = await request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return ojsonify({"error": "request body must be a JSON object"}, 400)
     inputs = data.get("inputs")
     conversation_id = data.get("conversation_id")
     is_temp = data.get("is_temp", True)
 
+    # Reject oversized prompts before they cost a model call or bloat the
+    # stored messages array
+    if not isinstance(inputs, str) or not inputs.strip():
+        return ojsonify({"error": "inputs must be a non-empty string"}, 400)
+    inputs = inputs.strip()
+    if len(inputs) > MAX_INPUT_CHARS:
+        return ojsonify({"error": "input too long", "max_chars": MAX_INPUT_CHARS}, 413)
+
+    if not is_temp:
+        if conversation_id:
+            # Turns are written after the response, so refuse another user's
+            # conversation now rather than dropping the turn in the writer
+            owned_by_other = await conversations_collection.find_one(
+                {"conversation_id": conversation_id, "user_id": {"$exists": True, "$ne": g.user_id}},
+                {"_id": 1}
+            )
+            if owned_by_other:
+                return ojsonify({"error": "Conversation not found"}, 404)
+        else:
+            conversation_id = str(ObjectId())
+
+    if data.get("stream"):
+        return stream_chat(inputs, conversation_id, g.user_id, is_temp), 200, {
+            "Content-Type": "text/event-stream",
+            "Cache-Control": "no-cache"
+        }
+
     try:
-        response_text = call_huggingface_chat_model(inputs)
+        response_text = await call_huggingface_chat_model(inputs)
     except Exception as e:
-        return jsonify({"error": "Model inference failed", "details": str(e)}), 500
+        return ojsonify({"error": "Model inference failed", "details": str(e)}, 500)
 
     # Save to MongoDB if not a temporary conversation
     if not is_temp:
-        if not conversation_id:
-            # Create new conversation
-            conversation_id = str(uuid.uuid4())
-            new_conversation = {
-                "conversation_id": conversation_id,
-                "title": inputs[:50],  # Truncate for title
-                "messages": [
-                    {"sender": "user", "text": inputs},
-                    {"sender": "bot", "text": response_text}
-                ],
-                "created_at": datetime.now(timezone.utc),
-                "updated_at": datetime.now(timezone.utc)
-            }
-            conversations_collection.insert_one(new_conversation)
-        else:
-            # Update existing conversation
-            conversations_collection.update_one(
-                {"conversation_id": conversation_id},
-                {
-                    "$push": {
-                        "messages": {
-                            "$each": [
-                                {"sender": "user", "text": inputs},
-                                {"sender": "bot", "text": response_text}
-                            ]
-                        }
-                    },
-                    "$set": {"updated_at": datetime.now(timezone.utc)}
-                }
-            )
-        
-        return jsonify({
+        await save_chat_turn(conversation_id, g.user_id, inputs, response_text)
+        return ojsonify({
             "response": response_text,
             "conversation_id": conversation_id
         })
-    else:
-        return jsonify({"response": response_text})
+    return ojsonify({"response": response_text})
 
+async def stream_chat(inputs, conversation_id, user_id, is_temp):
+    chunks = []
+    try:
+        async for delta in stream_huggingface_chat_model(inputs):
+            chunks.append(delta)
+            yield sse_event({"delta": delta})
+    except Exception as e:
+        yield sse_event({"error": "Model inference failed", "details": str(e)})
+        return
+
+    # Persist the full reply once the stream has finished
+    done = {"done": True}
+    if not is_temp:
+        await save_chat_turn(conversation_id, user_id, inputs, "".join(chunks))
+        done["conversation_id"] = conversation_id
+    yield sse_event(done)
 
-if __name__ == "__main__":
-    os.environ["DEBUG"] = "1"
-    app.run(debug=True)
\ No newline at end of file
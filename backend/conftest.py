@@ -0,0 +1 @@
+# Lets tests under backend/tests import app.py as a top-level module
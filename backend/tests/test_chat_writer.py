@@ -0,0 +1,41 @@
+import asyncio
+
+from pymongo.errors import BulkWriteError
+
+import app
+
+
+class FakeCollection:
+    def __init__(self, failures):
+        self.failures = list(failures)
+        self.calls = []
+
+    async def bulk_write(self, ops):
+        self.calls.append(ops)
+        if self.failures:
+            raise self.failures.pop(0)
+
+
+def turn(conversation_id):
+    return (conversation_id, f"update-{conversation_id}", f"archive-{conversation_id}")
+
+
+def test_failed_op_skipped_and_rest_retried(monkeypatch):
+    collection = FakeCollection([
+        BulkWriteError({"writeErrors": [{"index": 1, "errmsg": "E11000 duplicate key"}]})
+    ])
+    monkeypatch.setattr(app, "conversations_collection", collection)
+
+    turns = [turn("a"), turn("b"), turn("c")]
+    saved = asyncio.run(app.write_conversation_turns(turns))
+
+    assert saved == [turn("a"), turn("c")]
+    assert collection.calls == [["update-a", "update-b", "update-c"], ["update-c"]]
+
+
+def test_write_concern_error_keeps_every_turn(monkeypatch):
+    collection = FakeCollection([BulkWriteError({"writeErrors": [], "writeConcernErrors": [{}]})])
+    monkeypatch.setattr(app, "conversations_collection", collection)
+
+    turns = [turn("a"), turn("b")]
+    assert asyncio.run(app.write_conversation_turns(turns)) == turns
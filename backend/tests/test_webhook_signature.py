@@ -0,0 +1,39 @@
+import app
+
+# Reference vector from the Svix webhook verification docs
+SECRET = "whsec_MfKQ9r8GKYqrTwjUPD8ILPZIo2LaLaSw"
+MSG_ID = "msg_p5jXN8AQM9LWM0D4loKWxJek"
+TIMESTAMP = "1614265330"
+BODY = b'{"test": 2432232314}'
+SIGNATURE = "v1,g0hM9SsE+OTPJTGt/tmIKtSyZlE3uFJELVlNIOLJ1OE="
+
+
+def svix_headers(signature, timestamp=TIMESTAMP):
+    return {"svix-id": MSG_ID, "svix-timestamp": timestamp, "svix-signature": signature}
+
+
+def use_secret(monkeypatch, now=int(TIMESTAMP)):
+    monkeypatch.setattr(app, "webhook_signing_key", app.base64.b64decode(SECRET.removeprefix("whsec_")))
+    monkeypatch.setattr(app.time, "time", lambda: now)
+
+
+def test_valid_v1_signature(monkeypatch):
+    use_secret(monkeypatch)
+    assert app.verify_webhook_signature(svix_headers(SIGNATURE), BODY)
+
+
+def test_rotated_secret_entry(monkeypatch):
+    # During rotation the header carries one entry per active secret
+    use_secret(monkeypatch)
+    header = "v1,Ceo5qEr07ixe2NLpvHk3FH9bwy/WavXrAFQ/9tdO6mc= " + SIGNATURE
+    assert app.verify_webhook_signature(svix_headers(header), BODY)
+
+
+def test_stale_timestamp_rejected(monkeypatch):
+    use_secret(monkeypatch, now=int(TIMESTAMP) + app.WEBHOOK_TOLERANCE_SECONDS + 1)
+    assert not app.verify_webhook_signature(svix_headers(SIGNATURE), BODY)
+
+
+def test_tampered_body_rejected(monkeypatch):
+    use_secret(monkeypatch)
+    assert not app.verify_webhook_signature(svix_headers(SIGNATURE), BODY + b" ")
@@ -1,5 +1,6 @@
 import { useState, useEffect } from "react"; // Import useEffect
 import axios from "axios";
+import { useAuth } from "@clerk/clerk-react";
 import "./App.css";
 
 // --- Icons (Simple Placeholders) ---
@@ -142,6 +143,7 @@ const suggestionPrompts = [
 const BOT_NAME = "judiciAIre"; // Define bot name
 
 function App() {
+  const { getToken } = useAuth();
   // --- State Variables ---
   const [input, setInput] = useState("");
   // Load messages from localStorage or default to empty array
@@ -306,9 +308,12 @@ function App() {
     setEditingMessageIndex(null); // Cancel any ongoing edit when sending new message
 
     try {
-      const response = await axios.post(backendUrl, {
-        inputs: userMessage.text,
-      });
+      const token = await getToken();
+      const response = await axios.post(
+        backendUrl,
+        { inputs: userMessage.text },
+        { headers: { Authorization: `Bearer ${token}` } }
+      );
       const botText =
         response.data.response || "Sorry, I couldn't process that.";
       const botMessage = { sender: "bot", text: botText };